@@ -1,81 +1,210 @@
 from osgeo import gdal
 import numpy as np
 import pandas as pd
-import tqdm
+import pyarrow as pa
+import pyarrow.csv
 import argparse
+import collections
+import multiprocessing
 import os
+from numba import njit
 
+# don't list sibling files of the tiff on open, every worker opens it again
+gdal.SetConfigOption("GDAL_DISABLE_READDIR_ON_OPEN", "EMPTY_DIR")
+# larger range requests if the tiff is read from object storage (/vsicurl/, /vsis3/)
+gdal.SetConfigOption("CPL_VSIL_CURL_CHUNK_SIZE", "2097152")
 
-parser = argparse.ArgumentParser(description="preprocess tif files")
-parser.add_argument("--region", type=str, help="name of region")
-parser.add_argument(
-    "--band", type=str, default="pdsi", help="name of variable to process"
-)
-parser.add_argument("--endyear", type=int, default=2020, help="last year of data")
-parser.add_argument(
-    "--endmonth", type=int, default=1, help="last month of data, from 1 to 12"
-)
-args = parser.parse_args()
-region = args.region
-feature = args.band
-endyear = args.endyear
-endmonth = args.endmonth
-
-save_path = "data/preprocessed/"
-print(f"region {region}")
-print(f"band {feature}")
-
-
-ds = gdal.Open("data/raw/" + region + "_" + feature + ".tif")
-print(f"number of months {ds.RasterCount}")
-print(f"x dim {ds.RasterXSize}")
-print(f"y dim {ds.RasterYSize}")
-
-num_of_months = ds.RasterCount
-xsize = ds.RasterXSize
-ysize = ds.RasterYSize
-all_data = np.zeros((num_of_months, 1, ysize, xsize))
-
-curr_month = endmonth
-curr_year = endyear
-total_df = pd.DataFrame(columns=["y", "x", "value", "date"])
-
-
-for i in tqdm.tqdm(range(num_of_months - 1, 1, -1)):
-    if curr_month == 0:
-        curr_month = 12
-        curr_year -= 1
-
-    curr_date = str(curr_year) + "-" + str(curr_month)
-    band = ds.GetRasterBand(i)
-    data = band.ReadAsArray()
+# dataset opened in every worker, gdal datasets can't be shared between processes
+worker_ds = None
+worker_feature = None
+
+
+def init_worker(path, feature):
+    global worker_ds, worker_feature
+    # parallelism comes from the pool, one decompression thread per worker
+    gdal.SetConfigOption("GDAL_NUM_THREADS", "1")
+    # every block is read exactly once, so the cache only has to hold
+    # the blocks of the window being decoded, not grow per worker
+    gdal.SetConfigOption("GDAL_CACHEMAX", "16")
+    worker_ds = gdal.Open(path)
+    worker_feature = feature
+
+
+def read_window(window):
+    xoff, yoff, win_xsize, win_ysize = window
+    # all bands of the window at once, band i is stored at index i - 1
+    data = worker_ds.ReadAsArray(xoff, yoff, win_xsize, win_ysize)
+    data = data.reshape(worker_ds.RasterCount, win_ysize, win_xsize)
+    # model consumes float32, so there is no need to keep the cube in float64
+    data = data.astype(np.float32, copy=False)
     # terraclim features need to be normalized
-    if feature == "pdsi":
-        data = data / 100
-    elif feature == "pet" or feature == "tmmn" or feature == "tmmx":
-        data = data / 10
-    all_data[i][0] = data
-
-    df_row = (
-        pd.DataFrame(data, columns=list(range(xsize)))
-        .reset_index()
-        .melt(id_vars="index")
-        .rename(columns={"index": "y", "variable": "x"})
+    if worker_feature == "pdsi":
+        data /= 100
+    elif worker_feature == "pet" or worker_feature == "tmmn" or worker_feature == "tmmx":
+        data /= 10
+    return window, data
+
+
+def bounded_imap(pool, func, items, max_pending):
+    # like pool.imap, but at most max_pending results are held at once,
+    # so finished windows can't pile up faster than they are written
+    pending = collections.deque()
+    for item in items:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+@njit(cache=True)
+def fill_long_format(xoff, yoff, out_y, out_x, out_date):
+    # row k of the window table is (month t, pixel y, pixel x), as in data.reshape(-1),
+    # single-threaded since the cores are already taken by the worker pool
+    num_of_months, win_ysize, win_xsize = out_date.shape
+    for t in range(num_of_months):
+        for y in range(win_ysize):
+            for x in range(win_xsize):
+                out_y[t, y, x] = yoff + y
+                out_x[t, y, x] = xoff + x
+                out_date[t, y, x] = t
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="preprocess tif files")
+    parser.add_argument("--region", type=str, help="name of region")
+    parser.add_argument(
+        "--band", type=str, default="pdsi", help="name of variable to process"
+    )
+    parser.add_argument("--endyear", type=int, default=2020, help="last year of data")
+    parser.add_argument(
+        "--endmonth", type=int, default=1, help="last month of data, from 1 to 12"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        # cpus available to this process, respects cpusets unlike os.cpu_count()
+        default=len(os.sched_getaffinity(0))
+        if hasattr(os, "sched_getaffinity")
+        else os.cpu_count(),
+        help="number of processes",
+    )
+    parser.add_argument(
+        "--max-pending-mb",
+        type=int,
+        default=1024,
+        help="memory budget for windows being read or waiting to be written",
     )
-    df_row["date"] = curr_date
-    total_df = pd.concat([total_df, df_row])
-
-    curr_month -= 1
-
-np.save(save_path + region + "_" + feature + ".npy", all_data)
-total_df.to_csv(save_path + region + "_" + feature + ".csv")
-print(f"{region} global stats")
-print(f"mean: {np.mean(all_data)}")
-print(f"std: {np.std(all_data)}")
-num_of_channels = 1
-global_means = np.zeros((1, num_of_channels, 1, 1))
-global_stds = np.zeros((1, num_of_channels, 1, 1))
-global_means[0, 0, 0, 0] = np.mean(all_data)
-global_stds[0, 0, 0, 0] = np.std(all_data)
-np.save(save_path + region + "_" + feature + "_global_means.npy", global_means)
-np.save(save_path + region + "_" + feature + "_global_stds.npy", global_stds)
+    args = parser.parse_args()
+    region = args.region
+    feature = args.band
+    endyear = args.endyear
+    endmonth = args.endmonth
+
+    save_path = "data/preprocessed/"
+    raw_path = "data/raw/" + region + "_" + feature + ".tif"
+    print(f"region {region}")
+    print(f"band {feature}")
+
+    ds = gdal.Open(raw_path)
+    print(f"number of months {ds.RasterCount}")
+    print(f"x dim {ds.RasterXSize}")
+    print(f"y dim {ds.RasterYSize}")
+
+    num_of_months = ds.RasterCount
+    xsize = ds.RasterXSize
+    ysize = ds.RasterYSize
+    # native block size of the tiff, reading by blocks matches on-disk layout
+    block_xsize, block_ysize = ds.GetRasterBand(1).GetBlockSize()
+    windows = [
+        (xoff, yoff, min(block_xsize, xsize - xoff), min(block_ysize, ysize - yoff))
+        for yoff in range(0, ysize, block_ysize)
+        for xoff in range(0, xsize, block_xsize)
+    ]
+    ds = None
+    # windows in flight are bounded by bytes, a window holds all months of a block
+    window_bytes = num_of_months * block_xsize * block_ysize * 4  # float32
+    max_pending = max(1, args.max_pending_mb * 2**20 // window_bytes)
+    # workers beyond the number of pending windows would only sit idle
+    num_of_workers = min(args.workers, max_pending)
+
+    # dates of all bands, the last band is endyear-endmonth
+    dates = pd.date_range(
+        end=pd.Timestamp(year=endyear, month=endmonth, day=1),
+        periods=num_of_months,
+        freq="MS",
+    )
+    dates = pa.array(dates.year.astype(str) + "-" + dates.month.astype(str))
+
+    # cube is written block by block, so regions larger than RAM can be processed
+    all_data = np.lib.format.open_memmap(
+        save_path + region + "_" + feature + ".npy",
+        mode="w+",
+        dtype=np.float32,
+        shape=(num_of_months, 1, ysize, xsize),
+    )
+    # multithreaded arrow writer instead of row-by-row pandas formatting
+    schema = pa.schema(
+        [
+            ("y", pa.int64()),
+            ("x", pa.int64()),
+            ("value", pa.float32()),
+            ("date", pa.string()),
+        ]
+    )
+    writer = pyarrow.csv.CSVWriter(save_path + region + "_" + feature + ".csv", schema)
+    # mean and std from sum and sum of squares, accumulated in float64
+    # without materializing (all_data - mean) as np.std does
+    total_sum = 0.0
+    total_sq_sum = 0.0
+
+    # windows are independent, so they are read and scaled in parallel
+    # while the main process writes finished ones in order
+    with multiprocessing.Pool(
+        num_of_workers, initializer=init_worker, initargs=(raw_path, feature)
+    ) as pool:
+        for window, data in bounded_imap(
+            pool, read_window, windows, max_pending=max_pending
+        ):
+            xoff, yoff, win_xsize, win_ysize = window
+            all_data[:, 0, yoff : yoff + win_ysize, xoff : xoff + win_xsize] = data
+
+            flat = data.reshape(-1)
+            total_sum += flat.sum(dtype=np.float64)
+            total_sq_sum += np.einsum("i,i->", flat, flat, dtype=np.float64)
+
+            # coordinates and month indices filled in one threaded pass,
+            # date strings are then gathered by arrow without numpy temporaries
+            shape = (num_of_months, win_ysize, win_xsize)
+            out_y = np.empty(shape, dtype=np.int64)
+            out_x = np.empty(shape, dtype=np.int64)
+            out_date = np.empty(shape, dtype=np.int32)
+            fill_long_format(xoff, yoff, out_y, out_x, out_date)
+            writer.write_table(
+                pa.table(
+                    {
+                        "y": out_y.reshape(-1),
+                        "x": out_x.reshape(-1),
+                        "value": flat,
+                        "date": dates.take(pa.array(out_date.reshape(-1))),
+                    },
+                    schema=schema,
+                )
+            )
+
+    writer.close()
+    all_data.flush()
+
+    n = all_data.size
+    mean = total_sum / n
+    std = np.sqrt(max(total_sq_sum / n - mean**2, 0.0))
+    print(f"{region} global stats")
+    print(f"mean: {mean}")
+    print(f"std: {std}")
+    num_of_channels = 1
+    global_means = np.zeros((1, num_of_channels, 1, 1), dtype=np.float32)
+    global_stds = np.zeros((1, num_of_channels, 1, 1), dtype=np.float32)
+    global_means[0, 0, 0, 0] = mean
+    global_stds[0, 0, 0, 0] = std
+    np.save(save_path + region + "_" + feature + "_global_means.npy", global_means)
+    np.save(save_path + region + "_" + feature + "_global_stds.npy", global_stds)
@@ -0,0 +1,39 @@
+import math
+from typing import Optional
+
+from torch.utils.data import Dataset, DistributedSampler
+
+
+class ContiguousDistributedSampler(DistributedSampler):
+    """
+    Distributed sampler that gives every rank a contiguous range of indices,
+    so the recurrent state of each rank is carried over consecutive months
+        dataset: dataset to sample from,
+        num_replicas: number of ranks,
+        rank: rank of the current process,
+        pad: repeat the last index so all ranks get the same number of samples
+             (needed for training, where ranks synchronize every step)
+    """
+
+    def __init__(
+        self,
+        dataset: Dataset,
+        num_replicas: Optional[int] = None,
+        rank: Optional[int] = None,
+        pad: bool = True,
+    ):
+        super().__init__(dataset, num_replicas=num_replicas, rank=rank, shuffle=False)
+        self.pad = pad
+        chunk_size = math.ceil(len(self.dataset) / self.num_replicas)
+        self.start = min(self.rank * chunk_size, len(self.dataset))
+        self.end = min(self.start + chunk_size, len(self.dataset))
+        self.num_samples = chunk_size if self.pad else self.end - self.start
+        self.total_size = self.num_samples * self.num_replicas
+
+    def __iter__(self):
+        indices = list(range(self.start, self.end))
+        indices += [len(self.dataset) - 1] * (self.num_samples - len(indices))
+        return iter(indices)
+
+    def __len__(self):
+        return self.num_samples
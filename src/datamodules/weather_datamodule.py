@@ -5,6 +5,7 @@ import torch
 from pytorch_lightning import LightningDataModule
 from torch.utils.data import DataLoader, Dataset
 
+from src.datamodules.components.contiguous_sampler import ContiguousDistributedSampler
 from src.utils.data_utils import create_celled_data
 from src import utils
 
@@ -312,6 +313,18 @@ class WeatherDataModule(LightningDataModule):
             log.info(f"val dataset shape {self.data_val.data.shape}")
             log.info(f"test dataset shape {self.data_test.data.shape}")
 
+    def _sampler(self, dataset: Dataset, pad: bool):
+        # under ddp every rank gets a contiguous range of months,
+        # a strided DistributedSampler would break the recurrent state
+        if self.trainer is None or self.trainer.world_size == 1:
+            return None
+        return ContiguousDistributedSampler(
+            dataset,
+            num_replicas=self.trainer.world_size,
+            rank=self.trainer.global_rank,
+            pad=pad,
+        )
+
     def train_dataloader(self):
         return DataLoader(
             self.data_train,
@@ -319,6 +332,7 @@ class WeatherDataModule(LightningDataModule):
             num_workers=self.num_workers,
             pin_memory=self.pin_memory,
             shuffle=False,
+            sampler=self._sampler(self.data_train, pad=True),
         )
 
     def val_dataloader(self):
@@ -328,6 +342,7 @@ class WeatherDataModule(LightningDataModule):
             num_workers=self.num_workers,
             pin_memory=self.pin_memory,
             shuffle=False,
+            sampler=self._sampler(self.data_val, pad=False),
         )
 
     def test_dataloader(self):
@@ -337,4 +352,5 @@ class WeatherDataModule(LightningDataModule):
             num_workers=self.num_workers,
             pin_memory=self.pin_memory,
             shuffle=False,
+            sampler=self._sampler(self.data_test, pad=False),
         )
@@ -1,16 +1,18 @@
 import sys
-from typing import Any, List
+from typing import Any, Dict, List
 
 import numpy as np
 import torch
 import torch.nn as nn
 from pytorch_lightning import LightningModule
-from torch.autograd import Variable
 
+from src import utils
 from src.models.components.conv_block import ConvBlock
 from src.utils.metrics import metrics_celled
 from src.utils.plotting import make_heatmap
 
+log = utils.get_logger(__name__)
+
 
 class ScaledTanh(nn.Module):
     def __init__(self, coef: int = 10):
@@ -22,6 +24,14 @@ class ScaledTanh(nn.Module):
         return output
 
 
+@torch.jit.script
+def cell_update(prev_c, f_i, i_i, c_i, o_i):
+    # gate activations and state update are fused into a single kernel
+    next_c = prev_c * torch.sigmoid(f_i) + torch.sigmoid(i_i) * torch.tanh(c_i)
+    next_h = torch.tanh(next_c) * torch.sigmoid(o_i)
+    return next_c, next_h
+
+
 class RCNNModule(LightningModule):
     """Example of LightningModule for MNIST classification.
 
@@ -76,7 +86,8 @@ class RCNNModule(LightningModule):
         # number of bins for pdsi
         self.dropout = torch.nn.Dropout2d(p=dropout)
         self.num_class = num_classes
-        self.boundaries = torch.tensor(boundaries).cuda()
+        # buffer follows the module across devices, unlike a hardcoded .cuda()
+        self.register_buffer("boundaries", torch.tensor(boundaries), persistent=False)
 
         self.emb_size = embedding_size
         self.hid_size = hidden_state_size
@@ -98,7 +109,7 @@ class RCNNModule(LightningModule):
                 dilation=self.dilation,
                 groups=self.groups,
             ),
-            nn.ReLU(),
+            nn.ReLU(inplace=True),
             ConvBlock(
                 self.emb_size,
                 self.emb_size,
@@ -108,71 +119,42 @@ class RCNNModule(LightningModule):
             ),
         )
 
-        self.f_t = nn.Sequential(
-            ConvBlock(
-                self.hid_size + self.emb_size,
-                self.hid_size,
-                self.kernel_size,
-                stride=1,
-                padding=self.kernel_size // 2,
-            ),
-            nn.Sigmoid(),
-        )
-        self.i_t = nn.Sequential(
-            ConvBlock(
-                self.hid_size + self.emb_size,
-                self.hid_size,
-                self.kernel_size,
-                stride=1,
-                padding=self.kernel_size // 2,
-            ),
-            nn.Sigmoid(),
-        )
-        self.c_t = nn.Sequential(
-            ConvBlock(
-                self.hid_size + self.emb_size,
-                self.hid_size,
-                self.kernel_size,
-                stride=1,
-                padding=self.kernel_size // 2,
-            ),
-            nn.Tanh(),
-        )
-        self.o_t = nn.Sequential(
-            ConvBlock(
-                self.hid_size + self.emb_size,
-                self.hid_size,
-                self.kernel_size,
-                stride=1,
-                padding=self.kernel_size // 2,
-            ),
-            nn.Sigmoid(),
+        # forget, input, cell and output gates computed by a single conv,
+        # batchnorm and maxpool are per-channel so this matches four separate blocks
+        self.gates = ConvBlock(
+            self.hid_size + self.emb_size,
+            4 * self.hid_size,
+            self.kernel_size,
+            stride=1,
+            padding=self.kernel_size // 2,
         )
 
-        self.final_conv = nn.Sequential(
-            nn.Conv2d(
-                self.hid_size,
-                self.periods_forward,
-                kernel_size=1,
-                stride=1,
-                padding=0,
-                bias=False,
-            ),
-            ScaledTanh(self.tanh_coef),
-        )
-
-        self.final_classify = nn.Sequential(
-            ConvBlock(
-                self.hid_size,
-                self.num_class,
-                kernel_size=3,
-                stride=1,
-                padding=1,
-                dilation=1,
-                groups=1,
-            ),
-            nn.Sigmoid(),
-        )
+        # only the head used by the current mode is built
+        if mode == "regression":
+            self.final_conv = nn.Sequential(
+                nn.Conv2d(
+                    self.hid_size,
+                    self.periods_forward,
+                    kernel_size=1,
+                    stride=1,
+                    padding=0,
+                    bias=False,
+                ),
+                ScaledTanh(self.tanh_coef),
+            )
+        elif mode == "classification":
+            # raw logits, nn.CrossEntropyLoss applies log-softmax itself
+            self.final_classify = nn.Sequential(
+                ConvBlock(
+                    self.hid_size,
+                    self.num_class,
+                    kernel_size=3,
+                    stride=1,
+                    padding=1,
+                    dilation=1,
+                    groups=1,
+                ),
+            )
 
         self.register_buffer(
             "prev_state_h",
@@ -194,6 +176,18 @@ class RCNNModule(LightningModule):
                 requires_grad=False,
             ),
         )
+        # preallocated input of the gates conv, hidden state and embedding are
+        # copied into it every step instead of allocating a new torch.cat result
+        self.register_buffer(
+            "gate_in",
+            torch.empty(
+                self.batch_size,
+                self.hid_size + self.emb_size,
+                self.n_cells_hor,
+                self.n_cells_ver,
+            ),
+            persistent=False,
+        )
 
         self.mode = mode
         # loss
@@ -204,27 +198,26 @@ class RCNNModule(LightningModule):
             self.criterion = nn.CrossEntropyLoss()
             self.loss_name = "CrossEntropy"
 
+        # NHWC layout for conv weights and state, fastest path for cudnn convs
+        self.to(memory_format=torch.channels_last)
+
     def forward(self, x: torch.Tensor):
         prev_c = self.prev_state_c
         prev_h = self.prev_state_h
+        x = x.contiguous(memory_format=torch.channels_last)
         x = self.dropout(x)
         x_emb = self.embedding(x)
         if x_emb.shape[0] < self.batch_size:
             x_emb = torch.nn.functional.pad(
                 x_emb, pad=(0,0,0,0,0,0,0,self.batch_size - x_emb.shape[0]), value=0
             )
-        x_and_h = torch.cat([prev_h, x_emb], dim=1)
+        # detached alias, so the copies below do not chain onto the previous step's graph
+        x_and_h = self.gate_in.detach()
+        x_and_h[:, : self.hid_size].copy_(prev_h)
+        x_and_h[:, self.hid_size :].copy_(x_emb)
 
-        f_i = self.f_t(x_and_h)
-        i_i = self.i_t(x_and_h)
-        c_i = self.c_t(x_and_h)
-        o_i = self.o_t(x_and_h)
-
-        next_c = prev_c * f_i + i_i * c_i
-        next_h = torch.tanh(next_c) * o_i
-
-        assert prev_h.shape == next_h.shape
-        assert prev_c.shape == next_c.shape
+        f_i, i_i, c_i, o_i = self.gates(x_and_h).chunk(4, dim=1)
+        next_c, next_h = cell_update(prev_c, f_i, i_i, c_i, o_i)
 
         if self.mode == "regression":
             prediction = self.final_conv(next_h)
@@ -238,6 +231,9 @@ class RCNNModule(LightningModule):
     def step(self, batch: Any):
         x, y = batch
         preds = self.forward(x)
+        # truncated BPTT, gradients do not flow into previous batches
+        self.prev_state_c = self.prev_state_c.detach()
+        self.prev_state_h = self.prev_state_h.detach()
         # padding of last batch
         if y.shape[0] < self.batch_size:
             y = torch.nn.functional.pad(
@@ -245,7 +241,21 @@ class RCNNModule(LightningModule):
             )
         # checking last (forward) value of target
         loss = self.criterion(preds, y[:, -1, :, :])
-        return loss, preds, y[:, -1, :, :]
+        # padded samples are dropped from outputs used for metrics,
+        # under mixed precision preds are half, metrics need full precision
+        num_samples = x.shape[0]
+        return loss, preds[:num_samples].float(), y[:num_samples, -1, :, :]
+
+    def gather_outputs(self, tensor: torch.Tensor) -> torch.Tensor:
+        # under ddp every rank holds a contiguous, possibly shorter, range of samples,
+        # gather them in rank order so all ranks compute metrics on the full dataset
+        if self.trainer.world_size == 1:
+            return tensor
+        sizes = self.all_gather(torch.tensor(tensor.shape[0], device=self.device))
+        max_size = int(sizes.max())
+        padding = tensor.new_zeros((max_size - tensor.shape[0], *tensor.shape[1:]))
+        gathered = self.all_gather(torch.cat((tensor, padding), 0))
+        return torch.cat([gathered[i, :size] for i, size in enumerate(sizes)], 0)
 
     def rolling_step(self, batch: Any):
         x, y = batch
@@ -271,13 +281,43 @@ class RCNNModule(LightningModule):
         most_freq_values, most_freq_indices = torch.mode(x_binned, dim=1)
         return most_freq_values
 
-    def on_after_backward(self) -> None:
-        self.prev_state_c.detach_()
-        self.prev_state_h.detach_()
+    def on_load_checkpoint(self, checkpoint: Dict[str, Any]) -> None:
+        state_dict = checkpoint["state_dict"]
+        # checkpoints saved before gate fusion have separate f_t/i_t/c_t/o_t blocks,
+        # the fused block is their concatenation along output channels
+        old_gates = ["f_t", "i_t", "c_t", "o_t"]
+        if "f_t.0.CONV.weight" in state_dict:
+            for name in ["CONV.weight", "BNORM.running_mean", "BNORM.running_var"]:
+                state_dict["gates." + name] = torch.cat(
+                    [state_dict.pop(gate + ".0." + name) for gate in old_gates], dim=0
+                )
+            state_dict["gates.BNORM.num_batches_tracked"] = state_dict[
+                "f_t.0.BNORM.num_batches_tracked"
+            ]
+            for gate in old_gates:
+                state_dict.pop(gate + ".0.BNORM.num_batches_tracked")
+        # older checkpoints contain both heads, only the current mode's one is built
+        unused_head = "final_classify." if self.mode == "regression" else "final_conv."
+        unused_keys = [key for key in state_dict if key.startswith(unused_head)]
+        if self.mode == "classification" and unused_keys:
+            log.warning(
+                "Checkpoint was trained with the old classification head, which applied "
+                "a sigmoid before CrossEntropyLoss. Its weights are loaded, but "
+                "predictions and metrics are not equivalent, retrain the model."
+            )
+        for key in unused_keys:
+            state_dict.pop(key)
+
+    def on_train_epoch_start(self) -> None:
+        # every epoch starts from an empty hidden state
+        self.prev_state_c = torch.zeros_like(self.prev_state_c)
+        self.prev_state_h = torch.zeros_like(self.prev_state_h)
 
     def training_step(self, batch: Any, batch_idx: int):
         loss, preds, targets = self.step(batch)
-        self.log("train/loss", loss, on_step=False, on_epoch=True, prog_bar=True)
+        self.log(
+            "train/loss", loss, on_step=False, on_epoch=True, prog_bar=True, sync_dist=True
+        )
 
         # we can return here dict with any tensors
         # and then read it in some callback or in `training_epoch_end()`` below
@@ -286,12 +326,12 @@ class RCNNModule(LightningModule):
 
     def training_epoch_end(self, outputs: List[Any]):
         # `outputs` is a list of dicts returned from `training_step()`
-        all_targets = outputs[0]["targets"]
-        all_preds = outputs[0]["preds"]
-
-        for i in range(1, len(outputs)):
-            all_preds = torch.cat((all_preds, outputs[i]["preds"]), 0)
-            all_targets = torch.cat((all_targets, outputs[i]["targets"]), 0)
+        all_targets = self.gather_outputs(
+            torch.cat([output["targets"] for output in outputs], 0)
+        )
+        all_preds = self.gather_outputs(
+            torch.cat([output["preds"] for output in outputs], 0)
+        )
         all_preds = torch.softmax(all_preds, dim=1)
         all_preds = all_preds[:, 1, :, :]
         rocauc_table, ap_table, f1_table, thr = metrics_celled(all_targets, all_preds)
@@ -318,17 +358,19 @@ class RCNNModule(LightningModule):
 
     def validation_step(self, batch: Any, batch_idx: int):
         loss, preds, targets = self.step(batch)
-        self.log("val/loss", loss, on_step=False, on_epoch=True, prog_bar=True)
+        self.log(
+            "val/loss", loss, on_step=False, on_epoch=True, prog_bar=True, sync_dist=True
+        )
 
         return {"loss": loss, "preds": preds, "targets": targets}
 
     def validation_epoch_end(self, outputs: List[Any]):
-        all_targets = outputs[0]["targets"]
-        all_preds = outputs[0]["preds"]
-
-        for i in range(1, len(outputs)):
-            all_preds = torch.cat((all_preds, outputs[i]["preds"]), 0)
-            all_targets = torch.cat((all_targets, outputs[i]["targets"]), 0)
+        all_targets = self.gather_outputs(
+            torch.cat([output["targets"] for output in outputs], 0)
+        )
+        all_preds = self.gather_outputs(
+            torch.cat([output["preds"] for output in outputs], 0)
+        )
 
         all_preds = torch.softmax(all_preds, dim=1)
         all_preds = all_preds[:, 1, :, :]
@@ -360,29 +402,28 @@ class RCNNModule(LightningModule):
             baseline = self.rolling_step(batch)
         elif self.mode == "classification":
             baseline = self.class_baseline(batch)
-        self.log("test/loss", loss, on_step=False, on_epoch=True, prog_bar=True)
+        self.log(
+            "test/loss", loss, on_step=False, on_epoch=True, prog_bar=True, sync_dist=True
+        )
 
         return {"loss": loss, "preds": preds, "targets": targets, "baseline": baseline}
 
     def test_epoch_end(self, outputs: List[Any]):
-        all_targets = outputs[0]["targets"]
-        all_baselines = outputs[0]["baseline"]
-        all_preds = outputs[0]["preds"]
-
-        for i in range(1, len(outputs)):
-            all_preds = torch.cat((all_preds, outputs[i]["preds"]), 0)
-            all_targets = torch.cat((all_targets, outputs[i]["targets"]), 0)
-            all_baselines = torch.cat((all_baselines, outputs[i]["baseline"]), 0)
-        
-        # remove padded values
-        init_len = all_baselines.shape[0]
-        all_preds = all_preds[:init_len,:,:,:]
-        all_targets = all_targets[:init_len,:,:]
+        all_targets = self.gather_outputs(
+            torch.cat([output["targets"] for output in outputs], 0)
+        )
+        all_baselines = self.gather_outputs(
+            torch.cat([output["baseline"] for output in outputs], 0)
+        )
+        all_preds = self.gather_outputs(
+            torch.cat([output["preds"] for output in outputs], 0)
+        )
 
         all_preds = torch.softmax(all_preds, dim=1)
         # log confusion matrix
         preds_for_cm = torch.argmax(all_preds, dim=1)
-        self.logger.experiment.log_confusion_matrix(torch.flatten(all_targets), torch.flatten(preds_for_cm))
+        if self.trainer.is_global_zero:
+            self.logger.experiment.log_confusion_matrix(torch.flatten(all_targets), torch.flatten(preds_for_cm))
         # probability of first class
         all_preds = all_preds[:, 1, :, :]
 
@@ -390,14 +431,17 @@ class RCNNModule(LightningModule):
         self.saved_targets = all_targets
 
         # global baseline
-        all_global_baselines = self.global_avg.to("cuda:0")
+        all_global_baselines = self.global_avg.to(self.device)
         all_global_baselines = all_global_baselines.unsqueeze(0).repeat(
             len(all_targets), 1, 1
         )
         # all zeros baseline - no drought
         all_zeros = torch.zeros(
-            all_preds.shape[0], all_preds.shape[1], all_preds.shape[2]
-        ).to("cuda:0")
+            all_preds.shape[0],
+            all_preds.shape[1],
+            all_preds.shape[2],
+            device=self.device,
+        )
         rocauc_table, ap_table, f1_table, thr = metrics_celled(
             all_targets, all_preds, "test"
         )
@@ -488,9 +532,11 @@ class RCNNModule(LightningModule):
                 prog_bar=True,
             )
 
-        rocauc_path = make_heatmap(rocauc_table, filename="rocauc_spatial.png")
-        torch.save(rocauc_table, "rocauc_table.pt")
-        self.logger.experiment.log_image(rocauc_path)
+        # outputs are gathered, so files and images are written once
+        if self.trainer.is_global_zero:
+            rocauc_path = make_heatmap(rocauc_table, filename="rocauc_spatial.png")
+            torch.save(rocauc_table, "rocauc_table.pt")
+            self.logger.experiment.log_image(rocauc_path)
 
     def configure_optimizers(self):
         """Choose what optimizers and learning-rate schedulers to use in your optimization.
@@ -1,16 +1,20 @@
 import numpy as np
 import torch
-from torchmetrics.classification import AUROC, AveragePrecision, ROC
+from torchmetrics.functional.classification import (
+    binary_auroc,
+    binary_average_precision,
+    binary_roc,
+)
 from torcheval.metrics.functional import binary_f1_score
 
 
 def metrics_celled(all_targets, all_preds, mode: str = "train"):
-    rocauc_table = torch.zeros(all_preds.shape[1], all_preds.shape[2])
-    rocauc = AUROC(task="binary", num_classes=1)
+    # functional metrics are stateless, module metrics called per cell would
+    # accumulate every cell's predictions in their state
     rocauc_table = torch.tensor(
         [
             [
-                rocauc(all_preds[:, x, y], all_targets[:, x, y])
+                binary_auroc(all_preds[:, x, y], all_targets[:, x, y])
                 for x in range(all_preds.shape[1])
             ]
             for y in range(all_preds.shape[2])
@@ -23,12 +27,12 @@ def metrics_celled(all_targets, all_preds, mode: str = "train"):
     thresholds = torch.zeros(all_preds.shape[1], all_preds.shape[2])
 
     if mode == "test":
-        ap = AveragePrecision(task="binary")
-        roc = ROC(task="binary")
         for x in range(all_preds.shape[1]):
             for y in range(all_preds.shape[2]):
-                ap_table[x][y] = ap(all_preds[:, x, y], all_targets[:, x, y])
-                fpr, tpr, thr = roc(all_preds[:, x, y], all_targets[:, x, y])
+                ap_table[x][y] = binary_average_precision(
+                    all_preds[:, x, y], all_targets[:, x, y]
+                )
+                fpr, tpr, thr = binary_roc(all_preds[:, x, y], all_targets[:, x, y])
                 j_stat = tpr - fpr
                 ind = torch.argmax(j_stat).item()
                 thresholds[x][y] = thr[ind]